@@ -16,15 +16,20 @@
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
-from asyncio import get_event_loop, run, Queue, QueueEmpty, create_task, sleep
-from argparse import ArgumentParser, FileType
+from asyncio import get_running_loop, run, PriorityQueue, create_task, sleep
+from argparse import ArgumentParser, ArgumentTypeError, FileType
 from collections import deque
-from dataclasses import dataclass, field
-import json
+from dataclasses import dataclass
+from enum import IntEnum
+from itertools import count
+from types import MappingProxyType
 import logging
-import time
-from typing import Any, BinaryIO, Dict, Optional, Text, TextIO
+import re
+from typing import (
+    Any, BinaryIO, Deque, Dict, FrozenSet, Iterable, List, Mapping, Optional,
+    Text, TextIO, Tuple)
 
+import orjson
 import paho.mqtt.client as mqtt
 
 try:
@@ -33,8 +38,13 @@ except ImportError:
     async def create_serial_connection(*_, **__):
         raise ImportError('Serial device support requires pyserial-asyncio')
 
-from cbus.common import MIN_GROUP_ADDR, MAX_GROUP_ADDR, check_ga, Application
-from cbus.paho_asyncio import AsyncioHelper
+try:
+    import uvloop  # pytype: disable=import-error
+except ImportError:
+    # Fall back to the default asyncio event loop
+    uvloop = None
+
+from cbus.common import MIN_GROUP_ADDR, MAX_GROUP_ADDR, Application
 from cbus.protocol.pciprotocol import PCIProtocol
 from cbus.toolkit.cbz import CBZ
 
@@ -49,108 +59,370 @@ _TOPIC_CONF_SUFFIX = '/config'
 _TOPIC_STATE_SUFFIX = '/state'
 _META_TOPIC = 'homeassistant/binary_sensor/cbus_cmqttd'
 
-# Device type constants
-_DEVICE_TYPE_LIGHT = 'light'
-_DEVICE_TYPE_LIGHT_NON_DIMMABLE = 'light_non_dimmable'
-_DEVICE_TYPE_SWITCH = 'switch'
-_DEVICE_TYPE_BINARY_SENSOR = 'binary_sensor'
-_DEVICE_TYPE_IGNORE = 'ignore'
+# Payloads for switch and binary sensor state topics
+_STATE_ON = b'ON'
+_STATE_OFF = b'OFF'
+
+# Plain (non-JSON) payloads Home Assistant sends to switch command topics.
+_PLAIN_STATE_PAYLOADS = frozenset(
+    (_STATE_ON, _STATE_OFF, b'"ON"', b'"OFF"'))
+_PLAIN_STATES = frozenset((_STATE_ON, _STATE_OFF))
+
+# An entry in a comma-separated list of group addresses, skipping whitespace
+# and empty entries
+_GA_LIST_ITEM = re.compile(r'[^,\s]+')
+
+# Seconds to wait for the PCI to confirm a command before retrying it
+_CONFIRMATION_TIMEOUT = 0.25
+
+# Seconds to collect state publishes before sending them together
+_PUBLISH_COALESCE_DELAY = 0.005
+
+# Times a command is retried before giving up
+_MAX_RETRIES = 3
+
+# command_queue priorities; lower values are sent first
+_PRIORITY_RETRY = 0
+_PRIORITY_NEW = 1
+
 
+class DeviceType(IntEnum):
+    """How a group address is presented to Home Assistant."""
+    LIGHT = 0
+    LIGHT_NON_DIMMABLE = 1
+    SWITCH = 2
+    BINARY_SENSOR = 3
+    IGNORE = 4
 
-def ga_range():
-    return range(MIN_GROUP_ADDR, MAX_GROUP_ADDR + 1)
+
+_GA_RANGE = tuple(range(MIN_GROUP_ADDR, MAX_GROUP_ADDR + 1))
+
+
+def ga_range() -> Tuple[int, ...]:
+    return _GA_RANGE
+
+
+def _topic_table(prefix: Text, suffix: Text) -> Dict[int, Text]:
+    """Builds a group address -> topic lookup table."""
+    return {ga: prefix + str(ga) + suffix for ga in ga_range()}
+
+
+# Topics are fixed for each group address, so build them once rather than
+# concatenating strings for every event.
+_SET_TOPIC = _topic_table(_LIGHT_TOPIC_PREFIX, _TOPIC_SET_SUFFIX)
+_STATE_TOPIC = _topic_table(_LIGHT_TOPIC_PREFIX, _TOPIC_STATE_SUFFIX)
+_CONF_TOPIC = _topic_table(_LIGHT_TOPIC_PREFIX, _TOPIC_CONF_SUFFIX)
+_SWITCH_SET = _topic_table(_SWITCH_TOPIC_PREFIX, _TOPIC_SET_SUFFIX)
+_SWITCH_STATE = _topic_table(_SWITCH_TOPIC_PREFIX, _TOPIC_STATE_SUFFIX)
+_SWITCH_CONF = _topic_table(_SWITCH_TOPIC_PREFIX, _TOPIC_CONF_SUFFIX)
+_BINSENSOR_STATE = _topic_table(_BINSENSOR_TOPIC_PREFIX, _TOPIC_STATE_SUFFIX)
+_BINSENSOR_CONF = _topic_table(_BINSENSOR_TOPIC_PREFIX, _TOPIC_CONF_SUFFIX)
+
+# Reverse mapping of every command topic we subscribe to.
+_TOPIC_TO_GA = {topic: ga for table in (_SET_TOPIC, _SWITCH_SET)
+                for ga, topic in table.items()}  # type: Dict[Text, int]
 
 
 def get_topic_group_address(topic: Text) -> int:
     """Gets the group address for the given topic."""
-    # Support multiple topic prefixes
-    prefixes = [
-        _LIGHT_TOPIC_PREFIX,
-        _SWITCH_TOPIC_PREFIX,
-        _BINSENSOR_TOPIC_PREFIX,
-    ]
-    
-    for prefix in prefixes:
-        if topic.startswith(prefix) and topic.endswith(_TOPIC_SET_SUFFIX):
-            ga = int(topic[len(prefix):].split('/', maxsplit=1)[0])
-            check_ga(ga)
-            return ga
-    
-    raise ValueError(
-        f'Invalid topic {topic}, must start with a known prefix and end with {_TOPIC_SET_SUFFIX}')
+    try:
+        return _TOPIC_TO_GA[topic]
+    except KeyError:
+        raise ValueError(
+            f'Invalid topic {topic}, must start with a known prefix and end '
+            f'with {_TOPIC_SET_SUFFIX}') from None
+
+
+def decode_command_payload(payload: bytes) -> Optional[Dict[Text, Any]]:
+    """
+    Decodes the payload of a command sent by Home Assistant.
+
+    https://www.home-assistant.io/integrations/light.mqtt/#json-schema
+
+    Home Assistant sends JSON for lights, but plain strings ("ON"/"OFF") for
+    switches.
+
+    :returns: The command, with at least a 'state' key, or None if the payload
+              is not valid.
+    """
+    # Switches are the common case, so check for them before the JSON parser.
+    if payload in _PLAIN_STATE_PAYLOADS:
+        return {'state': payload.strip(b'"').decode('ascii')}
+
+    stripped = payload.lstrip()
+    if stripped[:1] == b'{':
+        try:
+            command = orjson.loads(stripped)
+        except orjson.JSONDecodeError:
+            return None
+        if isinstance(command.get('state'), str):
+            return command
+        return None
+
+    # Tolerate whitespace or lower case in plain payloads
+    state = payload.strip().strip(b'"').upper()
+    if state in _PLAIN_STATES:
+        return {'state': state.decode('ascii')}
+    return None
 
 
 def set_topic(group_addr: int) -> Text:
     """Gets the Set topic for a group address."""
-    return _LIGHT_TOPIC_PREFIX + str(group_addr) + _TOPIC_SET_SUFFIX
+    return _SET_TOPIC[group_addr]
 
 
 def state_topic(group_addr: int) -> Text:
     """Gets the State topic for a group address."""
-    return _LIGHT_TOPIC_PREFIX + str(group_addr) + _TOPIC_STATE_SUFFIX
+    return _STATE_TOPIC[group_addr]
 
 
 def conf_topic(group_addr: int) -> Text:
     """Gets the Config topic for a group address."""
-    return _LIGHT_TOPIC_PREFIX + str(group_addr) + _TOPIC_CONF_SUFFIX
+    return _CONF_TOPIC[group_addr]
 
 
 def bin_sensor_state_topic(group_addr: int) -> Text:
     """Gets the Binary Sensor State topic for a group address."""
-    return _BINSENSOR_TOPIC_PREFIX + str(group_addr) + _TOPIC_STATE_SUFFIX
+    return _BINSENSOR_STATE[group_addr]
 
 
 def bin_sensor_conf_topic(group_addr: int) -> Text:
     """Gets the Binary Sensor Config topic for a group address."""
-    return _BINSENSOR_TOPIC_PREFIX + str(group_addr) + _TOPIC_CONF_SUFFIX
+    return _BINSENSOR_CONF[group_addr]
 
 
-def get_device_type(group_addr: int, device_types: Dict[int, str]) -> str:
+def get_device_type(group_addr: int,
+                    device_types: Dict[int, DeviceType]) -> DeviceType:
     """Get device type for a group address, defaulting to dimmable light."""
-    return device_types.get(group_addr, _DEVICE_TYPE_LIGHT)
-
-
-def conf_topic_for_device(group_addr: int, device_type: str) -> Text:
+    return device_types.get(group_addr, DeviceType.LIGHT)
+
+
+# Topic tables for each device type; lights (dimmable or not) and ignored
+# devices use the light topics.
+_CONF_TOPICS = {
+    DeviceType.LIGHT: _CONF_TOPIC,
+    DeviceType.LIGHT_NON_DIMMABLE: _CONF_TOPIC,
+    DeviceType.SWITCH: _SWITCH_CONF,
+    DeviceType.BINARY_SENSOR: _BINSENSOR_CONF,
+    DeviceType.IGNORE: _CONF_TOPIC,
+}  # type: Dict[DeviceType, Dict[int, Text]]
+_STATE_TOPICS = {
+    DeviceType.LIGHT: _STATE_TOPIC,
+    DeviceType.LIGHT_NON_DIMMABLE: _STATE_TOPIC,
+    DeviceType.SWITCH: _SWITCH_STATE,
+    DeviceType.BINARY_SENSOR: _BINSENSOR_STATE,
+    DeviceType.IGNORE: _STATE_TOPIC,
+}  # type: Dict[DeviceType, Dict[int, Text]]
+
+
+def conf_topic_for_device(group_addr: int, device_type: DeviceType) -> Text:
     """Get config topic based on device type."""
-    if device_type == _DEVICE_TYPE_SWITCH:
-        return _SWITCH_TOPIC_PREFIX + str(group_addr) + _TOPIC_CONF_SUFFIX
-    elif device_type == _DEVICE_TYPE_BINARY_SENSOR:
-        return _BINSENSOR_TOPIC_PREFIX + str(group_addr) + _TOPIC_CONF_SUFFIX
-    else:  # light or light_non_dimmable (both use light topic)
-        return conf_topic(group_addr)
+    return _CONF_TOPICS[device_type][group_addr]
 
 
-def set_topic_for_device(group_addr: int, device_type: str) -> Text:
+def set_topic_for_device(group_addr: int, device_type: DeviceType) -> Text:
     """Get set topic based on device type (command topic).
     
     Note: For simplicity, all device types use the light set topic for commands.
     """
-    return set_topic(group_addr)
+    return _SET_TOPIC[group_addr]
 
 
-def state_topic_for_device(group_addr: int, device_type: str) -> Text:
+def state_topic_for_device(group_addr: int, device_type: DeviceType) -> Text:
     """Get state topic based on device type."""
-    if device_type == _DEVICE_TYPE_SWITCH:
-        return _SWITCH_TOPIC_PREFIX + str(group_addr) + _TOPIC_STATE_SUFFIX
-    elif device_type == _DEVICE_TYPE_BINARY_SENSOR:
-        return bin_sensor_state_topic(group_addr)
-    else:  # light or light_non_dimmable (both use light topic)
-        return state_topic(group_addr)
+    return _STATE_TOPICS[device_type][group_addr]
+
+
+# Home Assistant discovery configs are identical for every group address of a
+# device type except for the group address and name, so they are encoded once
+# as bytes %-format templates which _render_discovery_config fills in. The
+# placeholders are swapped for format fields by _discovery_template.
+_GA_PLACEHOLDER = '__GA__'
+_GA3_PLACEHOLDER = '__GA3__'  # zero-padded to 3 digits
+_NAME_PLACEHOLDER = '__NAME__'
+_GA_MARK = _GA_PLACEHOLDER.encode()
+_GA3_MARK = _GA3_PLACEHOLDER.encode()
+_NAME_MARK = orjson.dumps(_NAME_PLACEHOLDER)  # includes the JSON quotes
+
+
+def _discovery_template(config: Dict[Text, Any]) -> bytes:
+    """Encodes a discovery config with placeholders as a format template."""
+    return (orjson.dumps(config)
+            .replace(b'%', b'%%')
+            .replace(_GA3_MARK, b'%(ga)03d')
+            .replace(_GA_MARK, b'%(ga)d')
+            .replace(_NAME_MARK, b'%(name)s'))
+
+
+# Fields shared by the device block of every discovery config
+_DEVICE_BASE = MappingProxyType({
+    'sw_version': 'cbus2ha https://github.com/wazza-aus/cbus2ha',
+    'manufacturer': 'Clipsal CBus Home Automation',
+    'model': 'cbus2ha',
+})  # type: Mapping[Text, Text]
+
+
+def _device_block(identifier: Text, name: Text,
+                  **fields: Any) -> Dict[Text, Any]:
+    """Builds a discovery config device block from _DEVICE_BASE."""
+    return {'identifiers': [identifier], 'name': name, **_DEVICE_BASE,
+            **fields}
+
+
+def _discovery_device(kind: Text, description: Text) -> Dict[Text, Any]:
+    """Builds the device block of a discovery config template."""
+    return _device_block(
+        f'cbus_{kind}_{_GA_PLACEHOLDER}',
+        f'C-Bus {description} {_GA3_PLACEHOLDER}',
+        connections=[['cbus_group_address', _GA_PLACEHOLDER]],
+        via_device='cbus2ha')
+
+
+def _light_template(dimmable: bool) -> bytes:
+    return _discovery_template({
+        'name': _NAME_PLACEHOLDER,
+        'unique_id': f'cbus_light_{_GA_PLACEHOLDER}',
+        'cmd_t': _LIGHT_TOPIC_PREFIX + _GA_PLACEHOLDER + _TOPIC_SET_SUFFIX,
+        'stat_t': _LIGHT_TOPIC_PREFIX + _GA_PLACEHOLDER + _TOPIC_STATE_SUFFIX,
+        'schema': 'json',
+        'brightness': dimmable,
+        'device': _discovery_device('light', 'Light'),
+        'supported_color_modes': ['brightness' if dimmable else 'onoff'],
+    })
+
+
+_DISCOVERY_TEMPLATES = {
+    DeviceType.LIGHT: _light_template(dimmable=True),
+    DeviceType.LIGHT_NON_DIMMABLE: _light_template(dimmable=False),
+    DeviceType.SWITCH: _discovery_template({
+        'name': _NAME_PLACEHOLDER,
+        'unique_id': f'cbus_switch_{_GA_PLACEHOLDER}',
+        'cmd_t': _SWITCH_TOPIC_PREFIX + _GA_PLACEHOLDER + _TOPIC_SET_SUFFIX,
+        'stat_t': _SWITCH_TOPIC_PREFIX + _GA_PLACEHOLDER + _TOPIC_STATE_SUFFIX,
+        'schema': 'json',
+        'device': _discovery_device('switch', 'Switch'),
+    }),
+    DeviceType.BINARY_SENSOR: _discovery_template({
+        'name': _NAME_PLACEHOLDER,
+        'unique_id': f'cbus_binary_sensor_{_GA_PLACEHOLDER}',
+        'stat_t': (
+            _BINSENSOR_TOPIC_PREFIX + _GA_PLACEHOLDER + _TOPIC_STATE_SUFFIX),
+        'device': _discovery_device('binary_sensor', 'Binary Sensor'),
+    }),
+}  # type: Dict[DeviceType, bytes]
+
+
+def _render_discovery_config(template: bytes, ga: int, name: Text) -> bytes:
+    """Fills in a discovery config template for a group address."""
+    return template % {b'ga': ga, b'name': orjson.dumps(name)}
+
+
+# Meta-device which holds all the C-Bus group addresses
+_META_CONF_TOPIC = _META_TOPIC + _TOPIC_CONF_SUFFIX
+_META_CONFIG = orjson.dumps({
+    '~': _META_TOPIC,
+    'name': 'cbus2ha',
+    'unique_id': 'cbus2ha',
+    'stat_t': '~' + _TOPIC_STATE_SUFFIX,  # unused
+    'device': _device_block('cbus2ha', 'cbus2ha'),
+})
+
+
+# Light state payloads always have the same shape, so they are formatted
+# directly rather than built as a dict and serialised.
+_LIGHT_STATE_TEMPLATE = (
+    b'{"state":"%s","brightness":%d,"transition":%d,"cbus_source_addr":%s,'
+    b'"color_mode":"%(color_mode)s"}')
+
+
+def _light_state_payload(template: bytes, state: bytes, brightness: int,
+                         transition: int, source_addr: Optional[int]) -> bytes:
+    """Fills in a light state template from _GAInfo.light_state."""
+    return template % (
+        state, brightness, transition,
+        b'null' if source_addr is None else b'%d' % source_addr)
+
+
+@dataclass(slots=True, frozen=True)
+class _GAInfo:
+    """Precomputed, immutable details of a group address."""
+    device_type: DeviceType
+    state_topic: Text
+    conf_topic: Text
+    default_name: Text  # used when the group address has no label
+    light_state: bytes  # _LIGHT_STATE_TEMPLATE with the color_mode filled in
+    is_dimmable: bool
+    is_ignore: bool
+    is_binary_sensor: bool
+    plain_state: bool  # state is published as ON/OFF rather than JSON
+
+
+def _make_ga_info(group_addr: int, device_type: DeviceType) -> _GAInfo:
+    """Builds the _GAInfo for a group address of the given device type."""
+    return _GAInfo(
+        device_type=device_type,
+        state_topic=state_topic_for_device(group_addr, device_type),
+        conf_topic=conf_topic_for_device(group_addr, device_type),
+        default_name=(
+            f'C-Bus {device_type.name.replace("_", " ").title()} '
+            f'{group_addr:03d}'),
+        light_state=_LIGHT_STATE_TEMPLATE.replace(
+            b'%(color_mode)s',
+            b'onoff' if device_type == DeviceType.LIGHT_NON_DIMMABLE
+            else b'brightness'),
+        is_dimmable=device_type == DeviceType.LIGHT,
+        is_ignore=device_type == DeviceType.IGNORE,
+        is_binary_sensor=device_type == DeviceType.BINARY_SENSOR,
+        plain_state=device_type in (
+            DeviceType.SWITCH, DeviceType.BINARY_SENSOR),
+    )
+
 
+# _GAInfo for every device type and group address, so that state publishes
+# never need to resolve topics or branch on the device type.
+_GA_INFO = {
+    device_type: [_make_ga_info(ga, device_type)
+                  for ga in range(MAX_GROUP_ADDR + 1)]
+    for device_type in DeviceType
+}  # type: Dict[DeviceType, List[_GAInfo]]
 
-@dataclass
+
+def _build_all_discovery_configs(
+        labels: List[Optional[Text]], ga_info: List[_GAInfo],
+        group_addrs: Iterable[int]) -> List[Tuple[Text, bytes]]:
+    """
+    Builds the discovery configs for the meta-device and every group address.
+
+    :returns: (topic, payload) for each config, ready to publish.
+    """
+    configs = [(_META_CONF_TOPIC, _META_CONFIG)]
+    for ga in group_addrs:
+        info = ga_info[ga]
+
+        # Skip ignored devices completely
+        if info.is_ignore:
+            continue
+
+        name = labels[ga]
+        if name is None:
+            name = info.default_name
+        configs.append(
+            (info.conf_topic, _render_discovery_config(
+                _DISCOVERY_TEMPLATES[info.device_type], ga, name)))
+    return configs
+
+
+@dataclass(slots=True)
 class QueuedCommand:
     """Represents a command waiting to be sent or verified"""
     command_type: str  # 'on', 'off', 'ramp'
     group_addr: int
-    device_type: str
-    params: dict = field(default_factory=dict)  # brightness, transition_time, etc.
+    device_type: DeviceType
+    duration: int = 0  # ramp only
+    level: int = 0  # ramp only
     confirmation_code: Optional[bytes] = None
     timestamp: float = 0  # When command was sent
-    retry_count: int = 0
-    max_retries: int = 3
-    is_retry: bool = False  # True if this is a retry (for priority)
-    mqtt_state_update: Optional[dict] = None  # State to publish to HA after success
+    retry_count: int = 0  # Retries so far, up to _MAX_RETRIES
 
 
 class CBusHandler(PCIProtocol):
@@ -159,61 +431,112 @@ class CBusHandler(PCIProtocol):
     """
     mqtt_api = None
 
+    # command_type -> function which sends it, returning the confirmation code
+    _SEND_DISPATCH = {
+        'on': lambda self, cmd: self.lighting_group_on(cmd.group_addr),
+        'off': lambda self, cmd: self.lighting_group_off(cmd.group_addr),
+        'ramp': lambda self, cmd: self.lighting_group_ramp(
+            cmd.group_addr, cmd.duration, cmd.level),
+    }
+
     def __init__(self, labels: Optional[Dict[int, Text]], 
-                 device_types: Optional[Dict[int, str]] = None, 
+                 device_types: Optional[Dict[int, DeviceType]] = None, 
                  *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.labels = (
             labels if labels is not None else {})  # type: Dict[int, Text]
         self.device_types = (
-            device_types if device_types is not None else {})  # type: Dict[int, str]
+            device_types if device_types is not None else {})  # type: Dict[int, DeviceType]
+        # Indexed by group address
+        self._labels_arr = [
+            self.labels.get(ga)
+            for ga in range(MAX_GROUP_ADDR + 1)]  # type: List[Optional[Text]]
+        self._ga_info = [
+            _GA_INFO[get_device_type(ga, self.device_types)][ga]
+            for ga in range(MAX_GROUP_ADDR + 1)]  # type: List[_GAInfo]
+
+        # Group addresses which are not ignored
+        self._active_gas = tuple(
+            ga for ga in ga_range()
+            if not self._ga_info[ga].is_ignore)  # type: Tuple[int, ...]
+
+        # Set topics for all device types except ignored devices and binary
+        # sensors (read-only, no commands). Home Assistant may send commands to
+        # either the light or switch topic.
+        self._subscribe_topics = []  # type: List[Tuple[Text, int]]
+        for ga in self._active_gas:
+            if self._ga_info[ga].is_binary_sensor:
+                continue
+            self._subscribe_topics.append((_SET_TOPIC[ga], 2))
+            self._subscribe_topics.append((_SWITCH_SET[ga], 2))
+
+        # Built by discovery_configs() on the first connection to the broker
+        self._discovery_configs = None  # type: Optional[List[Tuple[Text, bytes]]]
         
         # Queue system
-        self.command_queue = Queue()  # FIFO queue for new commands
-        self.retry_queue = deque()  # Priority queue for retries (FIFO within retries)
+        # (priority, sequence, QueuedCommand); retries are sent before new
+        # commands, and the sequence keeps each priority FIFO.
+        self.command_queue = PriorityQueue()
+        self._queue_seq = count()
         self.pending_confirmations = {}  # confirmation_code -> QueuedCommand
+        # (deadline, confirmation_code) in the order commands were sent
+        self._pending_deadlines = deque()  # type: Deque[Tuple[float, bytes]]
+        self._deadline_handle = None  # type: Optional[asyncio.TimerHandle]
         self.queue_processor_task = None
-        self.timeout_watchdog_task = None
-        self.queue_lock = None  # Will be initialized as asyncio.Lock when loop is available
         self._queue_running = False
+        self._loop = get_running_loop()
+
 
+    def discovery_configs(self) -> List[Tuple[Text, bytes]]:
+        """
+        Gets the discovery configs for every active group address.
+
+        These never change, so they are built once and republished as-is
+        whenever the MQTT connection is re-established.
+        """
+        if self._discovery_configs is None:
+            self._discovery_configs = _build_all_discovery_configs(
+                self._labels_arr, self._ga_info, self._active_gas)
+        return self._discovery_configs
 
     def on_lighting_group_ramp(self, source_addr, group_addr, duration, level):
         if not self.mqtt_api:
             return
-        device_type = get_device_type(group_addr, self.device_types)
+        info = self._ga_info[group_addr]
         
         # Log but don't publish for ignored devices
-        if device_type == _DEVICE_TYPE_IGNORE:
+        if info.is_ignore:
             logger.info(f"Received CBUS ramp event for ignored device GA {group_addr}, ignoring")
             return
         
         self.mqtt_api.lighting_group_ramp(
-            source_addr, group_addr, duration, level, device_type)
+            source_addr, group_addr, duration, level, info.device_type)
 
     def on_lighting_group_on(self, source_addr, group_addr):
         if not self.mqtt_api:
             return
-        device_type = get_device_type(group_addr, self.device_types)
+        info = self._ga_info[group_addr]
         
         # Log but don't publish for ignored devices
-        if device_type == _DEVICE_TYPE_IGNORE:
+        if info.is_ignore:
             logger.info(f"Received CBUS on event for ignored device GA {group_addr}, ignoring")
             return
         
-        self.mqtt_api.lighting_group_on(source_addr, group_addr, device_type)
+        self.mqtt_api.lighting_group_on(
+            source_addr, group_addr, info.device_type)
 
     def on_lighting_group_off(self, source_addr, group_addr):
         if not self.mqtt_api:
             return
-        device_type = get_device_type(group_addr, self.device_types)
+        info = self._ga_info[group_addr]
         
         # Log but don't publish for ignored devices
-        if device_type == _DEVICE_TYPE_IGNORE:
+        if info.is_ignore:
             logger.info(f"Received CBUS off event for ignored device GA {group_addr}, ignoring")
             return
         
-        self.mqtt_api.lighting_group_off(source_addr, group_addr, device_type)
+        self.mqtt_api.lighting_group_off(
+            source_addr, group_addr, info.device_type)
 
     # TODO: on_lighting_group_terminate_ramp
 
@@ -227,48 +550,45 @@ class CBusHandler(PCIProtocol):
 
     # Queue system methods
     
-    async def queue_command(self, command_type: str, group_addr: int,
-                           device_type: str, params: dict, mqtt_state: dict):
+    def queue_command(self, command_type: str, group_addr: int,
+                      device_type: DeviceType, duration: int = 0,
+                      level: int = 0):
         """
-        Enqueue a command for processing.
+        Enqueue a command for processing. This may be called from any thread.
+
+        Home Assistant's state is updated once the PCI confirms the command.
         
         :param command_type: 'on', 'off', or 'ramp'
         :param group_addr: Group address
-        :param device_type: Device type string
-        :param params: Command parameters (brightness, duration, etc.)
-        :param mqtt_state: State to publish to HA after successful confirmation
+        :param device_type: Device type
+        :param duration: Ramp duration, in seconds (ramp only)
+        :param level: Ramp target level, 0 - 255 (ramp only)
         """
         cmd = QueuedCommand(
             command_type=command_type,
             group_addr=group_addr,
             device_type=device_type,
-            params=params,
-            mqtt_state_update=mqtt_state,
-            timestamp=0,
-            retry_count=0,
-            max_retries=3,
-            is_retry=False
+            duration=duration,
+            level=level,
         )
         
-        await self.command_queue.put(cmd)
+        self._loop.call_soon_threadsafe(
+            self.command_queue.put_nowait,
+            (_PRIORITY_NEW, next(self._queue_seq), cmd))
         logger.debug(f"Queued command: GA {group_addr} {command_type}")
 
+    def _queue_retry(self, cmd: QueuedCommand):
+        """Requeues a command ahead of any new commands."""
+        self.command_queue.put_nowait(
+            (_PRIORITY_RETRY, next(self._queue_seq), cmd))
+
     def _send_queued_command(self, cmd: QueuedCommand) -> Optional[bytes]:
         """
         Sends a queued command to CBUS and returns the confirmation code.
         This is synchronous - the lighting methods are blocking.
         """
         try:
-            if cmd.command_type == 'on':
-                conf_code = self.lighting_group_on(cmd.group_addr)
-                return conf_code
-            elif cmd.command_type == 'off':
-                conf_code = self.lighting_group_off(cmd.group_addr)
-                return conf_code
-            elif cmd.command_type == 'ramp':
-                conf_code = self.lighting_group_ramp(
-                    cmd.group_addr, cmd.params['duration'], cmd.params['level'])
-                return conf_code
+            return self._SEND_DISPATCH[cmd.command_type](self, cmd)
         except Exception as e:
             logger.error(f"Error sending command GA {cmd.group_addr} {cmd.command_type}: {e}", exc_info=e)
             return None
@@ -280,48 +600,34 @@ class CBusHandler(PCIProtocol):
         """
         self._queue_running = True
         logger.info("Queue processor started")
-        
-        # Ensure lock is initialized
-        if self.queue_lock is None:
-            from asyncio import Lock
-            self.queue_lock = Lock()
-        
+        loop = self._loop
+
         while self._queue_running:
             try:
-                # Check retry queue first (priority)
-                if self.retry_queue:
-                    cmd = self.retry_queue.popleft()
-                    logger.info(f"Processing retry {cmd.retry_count}/{cmd.max_retries} for GA {cmd.group_addr}: {cmd.command_type}")
-                else:
-                    # Get next command from main queue (non-blocking)
-                    try:
-                        cmd = self.command_queue.get_nowait()
-                    except QueueEmpty:
-                        # No commands, wait a bit before checking again
-                        await sleep(0.1)
-                        continue
+                priority, _, cmd = await self.command_queue.get()
+                if priority == _PRIORITY_RETRY:
+                    logger.info(f"Processing retry {cmd.retry_count}/{_MAX_RETRIES} for GA {cmd.group_addr}: {cmd.command_type}")
                 
                 # Send command to CBUS (synchronous call)
                 confirmation_code = self._send_queued_command(cmd)
                 
                 if confirmation_code:
                     # Track for confirmation matching
-                    async with self.queue_lock:
-                        cmd.confirmation_code = confirmation_code
-                        cmd.timestamp = time.time()
-                        self.pending_confirmations[confirmation_code] = cmd
+                    cmd.confirmation_code = confirmation_code
+                    cmd.timestamp = loop.time()
+                    self.pending_confirmations[confirmation_code] = cmd
+                    self._track_deadline(cmd.timestamp, confirmation_code)
                     
                     logger.debug(f"Sent command GA {cmd.group_addr} {cmd.command_type}, waiting for confirmation {confirmation_code!r}")
                 else:
                     # No confirmation requested or error
                     logger.warning(f"Command GA {cmd.group_addr} {cmd.command_type} returned no confirmation code")
                     # Treat as immediate failure, retry if possible
-                    if cmd.retry_count < cmd.max_retries:
+                    if cmd.retry_count < _MAX_RETRIES:
                         cmd.retry_count += 1
-                        cmd.is_retry = True
-                        self.retry_queue.append(cmd)
+                        self._queue_retry(cmd)
                     else:
-                        logger.error(f"Command GA {cmd.group_addr} {cmd.command_type} failed after {cmd.max_retries} attempts (no confirmation)")
+                        logger.error(f"Command GA {cmd.group_addr} {cmd.command_type} failed after {_MAX_RETRIES} attempts (no confirmation)")
                 
                 # Wait 100ms before next command (rate limiting)
                 await sleep(0.1)
@@ -332,73 +638,77 @@ class CBusHandler(PCIProtocol):
         
         logger.info("Queue processor stopped")
 
-    async def _timeout_watchdog(self):
+    def _track_deadline(self, sent_at: float, conf_code: bytes):
+        """Starts the confirmation timeout for a command sent at sent_at."""
+        deadline = sent_at + _CONFIRMATION_TIMEOUT
+        # Every command has the same timeout, so deadlines are always appended
+        # in order, and only the earliest one needs a timer.
+        self._pending_deadlines.append((deadline, conf_code))
+        if self._deadline_handle is None:
+            self._deadline_handle = self._loop.call_at(
+                deadline, self._expire_confirmations)
+
+    def _expire_confirmations(self):
+        """Times out every pending confirmation whose deadline has passed."""
+        self._deadline_handle = None
+        now = self._loop.time()
+        deadlines = self._pending_deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, conf_code = deadlines.popleft()
+            cmd = self.pending_confirmations.get(conf_code)
+            # Skip commands which were confirmed, or whose code has since been
+            # reused by a newer command.
+            if cmd is not None and (
+                    cmd.timestamp + _CONFIRMATION_TIMEOUT <= now):
+                self._on_timeout(conf_code, cmd)
+
+        if deadlines:
+            self._deadline_handle = self._loop.call_at(
+                deadlines[0][0], self._expire_confirmations)
+
+    def _on_timeout(self, conf_code: bytes, cmd: QueuedCommand):
         """
-        Monitors pending confirmations and retries commands that timeout.
-        Runs every 50ms to check for 250ms timeouts.
+        Called when a command has not been confirmed within
+        _CONFIRMATION_TIMEOUT seconds. Retries the command if possible.
         """
-        logger.info("Timeout watchdog started")
-        
-        if self.queue_lock is None:
-            from asyncio import Lock
-            self.queue_lock = Lock()
-        
-        while self._queue_running:
-            await sleep(0.05)  # Check every 50ms
-            
-            current_time = time.time()
-            timed_out = []
-            
-            async with self.queue_lock:
-                for conf_code, cmd in list(self.pending_confirmations.items()):
-                    # If no confirmation received within 250ms
-                    if current_time - cmd.timestamp > 0.25:
-                        timed_out.append((conf_code, cmd))
-            
-            # Handle timeouts outside the lock
-            for conf_code, cmd in timed_out:
-                logger.info(f"Confirmation timeout for GA {cmd.group_addr} {cmd.command_type} (code {conf_code!r})")
-                
-                async with self.queue_lock:
-                    if conf_code in self.pending_confirmations:
-                        del self.pending_confirmations[conf_code]
-                
-                # Retry if possible
-                if cmd.retry_count < cmd.max_retries:
-                    cmd.retry_count += 1
-                    cmd.is_retry = True
-                    cmd.confirmation_code = None
-                    cmd.timestamp = 0
-                    self.retry_queue.append(cmd)
-                    logger.info(f"Scheduling timeout retry {cmd.retry_count}/{cmd.max_retries} for GA {cmd.group_addr}")
-                else:
-                    logger.error(f"Command GA {cmd.group_addr} {cmd.command_type} timed out after {cmd.max_retries} retries")
-                    # Don't update Home Assistant state
-        
-        logger.info("Timeout watchdog stopped")
+
+        logger.info(f"Confirmation timeout for GA {cmd.group_addr} {cmd.command_type} (code {conf_code!r})")
+        del self.pending_confirmations[conf_code]
+
+        # Retry if possible
+        if cmd.retry_count < _MAX_RETRIES:
+            cmd.retry_count += 1
+            cmd.confirmation_code = None
+            cmd.timestamp = 0
+            self._queue_retry(cmd)
+            logger.info(f"Scheduling timeout retry {cmd.retry_count}/{_MAX_RETRIES} for GA {cmd.group_addr}")
+        else:
+            logger.error(f"Command GA {cmd.group_addr} {cmd.command_type} timed out after {_MAX_RETRIES} retries")
+            # Don't update Home Assistant state
 
     def start_queue_system(self):
-        """Start the queue processor and timeout watchdog."""
+        """Start the queue processor."""
         if self._queue_running:
             return
-        
-        # Initialize queue lock
-        from asyncio import Lock
-        if self.queue_lock is None:
-            self.queue_lock = Lock()
-        
-        loop = get_event_loop()
+
         self.queue_processor_task = create_task(self._queue_processor())
-        self.timeout_watchdog_task = create_task(self._timeout_watchdog())
         logger.info("Queue system started")
 
     def stop_queue_system(self):
-        """Stop the queue processor and timeout watchdog."""
+        """Stop the queue processor, and fail commands awaiting confirmation."""
         self._queue_running = False
         if self.queue_processor_task:
             self.queue_processor_task.cancel()
-        if self.timeout_watchdog_task:
-            self.timeout_watchdog_task.cancel()
+        if self._deadline_handle:
+            self._deadline_handle.cancel()
+            self._deadline_handle = None
+        self._pending_deadlines.clear()
+
+        # Without the timer these can never time out or be retried, and the
+        # PCI won't confirm them once the queue has stopped.
+        for cmd in self.pending_confirmations.values():
+            logger.warning(f"Command GA {cmd.group_addr} {cmd.command_type} abandoned awaiting confirmation")
+        self.pending_confirmations.clear()
         logger.info("Queue system stopped")
 
     def on_confirmation(self, code: bytes, success: bool):
@@ -407,167 +717,113 @@ class CBusHandler(PCIProtocol):
         """
         # Call parent first (for logging)
         super().on_confirmation(code, success)
-        
-        # Match confirmation to pending command
-        async def handle_confirmation():
-            if self.queue_lock is None:
-                from asyncio import Lock
-                self.queue_lock = Lock()
-            
-            async with self.queue_lock:
-                if code not in self.pending_confirmations:
-                    # This is expected for system commands (time sync, etc.)
-                    # that aren't tracked in the queue
-                    logger.debug(f"Received confirmation {code!r} with no matching pending command (likely system command)")
-                    return
-                
-                cmd = self.pending_confirmations[code]
-                del self.pending_confirmations[code]
-            
-            if success:
-                # Command succeeded - update Home Assistant state
-                logger.info(f"Command confirmed: GA {cmd.group_addr} {cmd.command_type} (confirmation {code!r})")
-                
-                if self.mqtt_api and cmd.mqtt_state_update:
-                    # Update Home Assistant state
-                    if cmd.command_type == 'on':
-                        self.mqtt_api.lighting_group_on(
-                            None, cmd.group_addr, cmd.device_type)
-                    elif cmd.command_type == 'off':
-                        self.mqtt_api.lighting_group_off(
-                            None, cmd.group_addr, cmd.device_type)
-                    elif cmd.command_type == 'ramp':
-                        self.mqtt_api.lighting_group_ramp(
-                            None, cmd.group_addr,
-                            cmd.params['duration'], cmd.params['level'],
-                            cmd.device_type)
-            else:
-                # Command failed - retry if possible
-                logger.info(f"Command failed: GA {cmd.group_addr} {cmd.command_type} (confirmation {code!r})")
-                
-                if cmd.retry_count < cmd.max_retries:
-                    cmd.retry_count += 1
-                    cmd.is_retry = True
-                    cmd.confirmation_code = None
-                    cmd.timestamp = 0
-                    # Add to retry queue (priority)
-                    self.retry_queue.append(cmd)
-                    logger.info(f"Scheduling retry {cmd.retry_count}/{cmd.max_retries} for GA {cmd.group_addr}")
-                else:
-                    logger.error(f"Command GA {cmd.group_addr} {cmd.command_type} failed after {cmd.max_retries} retries")
-                    # Don't update Home Assistant state - it stays as-is
-        
-        # Schedule in event loop (since we're in callback context)
-        try:
-            loop = get_event_loop()
-            if loop.is_running():
-                # Schedule async function
-                asyncio.ensure_future(handle_confirmation(), loop=loop)
+        # Confirmations are parsed from data_received, which already runs on
+        # the event loop thread.
+        self._handle_confirmation(code, success)
+
+    def _handle_confirmation(self, code: bytes, success: bool):
+        """Matches a confirmation to a pending command."""
+        cmd = self.pending_confirmations.pop(code, None)
+        if cmd is None:
+            # This is expected for system commands (time sync, etc.)
+            # that aren't tracked in the queue
+            logger.debug(f"Received confirmation {code!r} with no matching pending command (likely system command)")
+            return
+
+        if success:
+            # Command succeeded - update Home Assistant state
+            logger.info(f"Command confirmed: GA {cmd.group_addr} {cmd.command_type} (confirmation {code!r})")
+
+            if self.mqtt_api:
+                # Update Home Assistant state
+                if cmd.command_type == 'on':
+                    self.mqtt_api.lighting_group_on(
+                        None, cmd.group_addr, cmd.device_type)
+                elif cmd.command_type == 'off':
+                    self.mqtt_api.lighting_group_off(
+                        None, cmd.group_addr, cmd.device_type)
+                elif cmd.command_type == 'ramp':
+                    self.mqtt_api.lighting_group_ramp(
+                        None, cmd.group_addr,
+                        cmd.duration, cmd.level,
+                        cmd.device_type)
+        else:
+            # Command failed - retry if possible
+            logger.info(f"Command failed: GA {cmd.group_addr} {cmd.command_type} (confirmation {code!r})")
+
+            if cmd.retry_count < _MAX_RETRIES:
+                cmd.retry_count += 1
+                cmd.confirmation_code = None
+                cmd.timestamp = 0
+                self._queue_retry(cmd)
+                logger.info(f"Scheduling retry {cmd.retry_count}/{_MAX_RETRIES} for GA {cmd.group_addr}")
             else:
-                # If loop not running, try to run it
-                try:
-                    loop.run_until_complete(handle_confirmation())
-                except RuntimeError:
-                    # Loop already running in another thread, schedule it
-                    asyncio.ensure_future(handle_confirmation())
-        except RuntimeError:
-            # No event loop available, try to get/create one
-            try:
-                loop = get_event_loop()
-                asyncio.ensure_future(handle_confirmation(), loop=loop)
-            except RuntimeError:
-                logger.error("Cannot schedule confirmation handler: no event loop available")
+                logger.error(f"Command GA {cmd.group_addr} {cmd.command_type} failed after {_MAX_RETRIES} retries")
+                # Don't update Home Assistant state - it stays as-is
 
 
 class MqttClient(mqtt.Client):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = get_running_loop()
+        # topic -> payload, waiting for _flush_publishes
+        self._pending_publishes = {}  # type: Dict[Text, bytes]
+        self._flush_handle = None  # type: Optional[asyncio.TimerHandle]
+
     def on_connect(self, client, userdata: CBusHandler, flags, rc):
+        # Called from paho's network thread; the queue system and publishes
+        # must run on the event loop.
+        self._loop.call_soon_threadsafe(self._handle_connect, userdata)
+
+    def _handle_connect(self, userdata: CBusHandler):
         logger.info('Connected to MQTT broker')
         userdata.mqtt_api = self
         
         # Start queue system
         userdata.start_queue_system()
         
-        # Subscribe to set topics for all device types (except ignored and binary sensors)
-        topics = []
-        for ga in ga_range():
-            device_type = get_device_type(ga, userdata.device_types)
-            
-            # Skip ignored devices (no subscriptions)
-            if device_type == _DEVICE_TYPE_IGNORE:
-                continue
-            
-            # Skip binary sensors (read-only, no commands)
-            if device_type == _DEVICE_TYPE_BINARY_SENSOR:
-                continue
-            
-            # Subscribe to light set topic (used for all lights)
-            topics.append((set_topic(ga), 2))
-            # Also subscribe to switch topics (Home Assistant might send commands to these)
-            topics.append((_SWITCH_TOPIC_PREFIX + str(ga) + _TOPIC_SET_SUFFIX, 2))
-        
-        self.subscribe(topics)
-        self.publish_all_lights(userdata.labels, userdata.device_types)
+        self.subscribe(userdata._subscribe_topics)
+        self.publish_discovery_configs(userdata.discovery_configs())
 
     def on_message(self, client, userdata: CBusHandler, msg: mqtt.MQTTMessage):
-        """Handle a message from an MQTT subscription."""
-        # Check if it's a set topic (any device type)
-        if not msg.topic.endswith(_TOPIC_SET_SUFFIX):
-            return
+        """
+        Handle a message from an MQTT subscription.
 
-        try:
-            ga = get_topic_group_address(msg.topic)
-        except ValueError:
-            # Invalid group address
-            logging.error(f'Invalid group address in topic {msg.topic}')
+        This runs on paho's network thread, and only hands commands to the
+        event loop through CBusHandler.queue_command.
+        """
+        # Every set topic we subscribe to maps directly to a group address
+        ga = _TOPIC_TO_GA.get(msg.topic)
+        if ga is None:
+            if msg.topic.endswith(_TOPIC_SET_SUFFIX):
+                # Invalid group address
+                logging.error(f'Invalid group address in topic {msg.topic}')
             return
 
-        # Get device type for this group address
-        device_type = get_device_type(ga, userdata.device_types)
+        info = userdata._ga_info[ga]
+        device_type = info.device_type
         
         # Reject commands for ignored devices
-        if device_type == _DEVICE_TYPE_IGNORE:
+        if info.is_ignore:
             logger.info(f"Received command for ignored device GA {ga}, ignoring")
             return
         
         # Reject commands for binary sensors (read-only)
-        if device_type == _DEVICE_TYPE_BINARY_SENSOR:
+        if info.is_binary_sensor:
             logger.info(f"Received command for read-only binary sensor GA {ga}, ignoring")
             return
 
-        # https://www.home-assistant.io/integrations/light.mqtt/#json-schema
-        # Home Assistant sends JSON for lights, but plain strings ("ON"/"OFF") for switches
-        try:
-            payload = json.loads(msg.payload)
-        except (json.JSONDecodeError, ValueError):
-            # If JSON parsing fails, treat as plain string (for switches)
-            # Home Assistant sends "ON" or "OFF" as plain strings for switches
-            try:
-                payload_str = msg.payload.decode('utf-8').strip().upper()
-                if payload_str in ('ON', 'OFF'):
-                    payload = {'state': payload_str}
-                else:
-                    logging.error(f'Invalid payload format in {msg.topic}: {msg.payload}')
-                    return
-            except (AttributeError, UnicodeDecodeError):
-                # If payload is already a string or decode fails, try direct conversion
-                payload_str = str(msg.payload).strip().upper()
-                if payload_str in ('ON', 'OFF', '"ON"', '"OFF"'):
-                    # Remove quotes if present
-                    payload_str = payload_str.strip('"\'')
-                    payload = {'state': payload_str}
-                else:
-                    logging.error(f'Invalid payload format in {msg.topic}: {msg.payload}')
-                    return
-        except Exception as e:
-            logging.error(f'Unexpected error parsing payload in {msg.topic}: {e}', exc_info=e)
+        payload = decode_command_payload(msg.payload)
+        if payload is None:
+            logging.error(f'Invalid payload format in {msg.topic}: {msg.payload}')
             return
 
         light_on = payload['state'].upper() == 'ON'
         brightness = int(payload.get('brightness', 255))
 
         # Clamp brightness for non-dimmable lights and switches
-        if device_type in (_DEVICE_TYPE_LIGHT_NON_DIMMABLE, _DEVICE_TYPE_SWITCH):
+        if not info.is_dimmable:
             # Only full on or off
             brightness = 255 if light_on else 0
         else:
@@ -582,301 +838,108 @@ class MqttClient(mqtt.Client):
             transition_time = 0
 
         # For non-dimmable lights and switches, ignore transition
-        if device_type in (_DEVICE_TYPE_LIGHT_NON_DIMMABLE, _DEVICE_TYPE_SWITCH):
+        if not info.is_dimmable:
             transition_time = 0
 
         # Queue command for processing (state will be updated after confirmation)
-        async def enqueue_command():
-            if light_on:
-                if brightness == 255 and transition_time == 0:
-                    # lighting on
-                    mqtt_state = {
-                        'state': 'ON',
-                        'brightness': 255,
-                        'transition': 0,
-                        'device_type': device_type
-                    }
-                    await userdata.queue_command(
-                        'on', ga, device_type, {}, mqtt_state)
-                else:
-                    # ramp
-                    mqtt_state = {
-                        'state': 'ON' if brightness > 0 else 'OFF',
-                        'brightness': brightness,
-                        'transition': transition_time,
-                        'device_type': device_type
-                    }
-                    await userdata.queue_command(
-                        'ramp', ga, device_type,
-                        {'duration': transition_time, 'level': brightness},
-                        mqtt_state)
+        if light_on:
+            if brightness == 255 and transition_time == 0:
+                # lighting on
+                userdata.queue_command('on', ga, device_type)
             else:
-                # lighting off
-                if transition_time > 0:
-                    # ramp down to 0 over the transition period
-                    mqtt_state = {
-                        'state': 'OFF',
-                        'brightness': 0,
-                        'transition': transition_time,
-                        'device_type': device_type
-                    }
-                    await userdata.queue_command(
-                        'ramp', ga, device_type,
-                        {'duration': transition_time, 'level': 0},
-                        mqtt_state)
-                else:
-                    # immediate off
-                    mqtt_state = {
-                        'state': 'OFF',
-                        'brightness': 0,
-                        'transition': 0,
-                        'device_type': device_type
-                    }
-                    await userdata.queue_command(
-                        'off', ga, device_type, {}, mqtt_state)
-        
-        # Schedule command in event loop (on_message is sync callback)
-        try:
-            loop = get_event_loop()
-            if loop.is_running():
-                asyncio.ensure_future(enqueue_command(), loop=loop)
+                # ramp
+                userdata.queue_command(
+                    'ramp', ga, device_type, transition_time, brightness)
+        else:
+            # lighting off
+            if transition_time > 0:
+                # ramp down to 0 over the transition period
+                userdata.queue_command(
+                    'ramp', ga, device_type, transition_time, 0)
             else:
-                # Try to run it
-                try:
-                    loop.run_until_complete(enqueue_command())
-                except RuntimeError:
-                    # Loop already running, schedule it
-                    asyncio.ensure_future(enqueue_command())
-        except RuntimeError:
-            # No event loop available
-            try:
-                loop = get_event_loop()
-                asyncio.ensure_future(enqueue_command(), loop=loop)
-            except RuntimeError:
-                logger.error(f"Cannot queue command GA {ga}: no event loop available")
+                # immediate off
+                userdata.queue_command('off', ga, device_type)
 
     def publish(self, topic: Text, payload: Dict[Text, Any]):
-        """Publishes a payload as JSON."""
-        payload = json.dumps(payload)
-        return super().publish(topic, payload, 1, True)
-
-    def publish_all_lights(self, labels: Dict[int, Text], 
-                          device_types: Dict[int, str]):
-        """Publishes configuration for all devices based on their types."""
-        # Meta-device which holds all the C-Bus group addresses
-        self.publish(_META_TOPIC + _TOPIC_CONF_SUFFIX, {
-            '~': _META_TOPIC,
-            'name': 'cbus2ha',
-            'unique_id': 'cbus2ha',
-            'stat_t': '~' + _TOPIC_STATE_SUFFIX,  # unused
-            'device': {
-                'identifiers': ['cbus2ha'],
-                'sw_version': 'cbus2ha https://github.com/wazza-aus/cbus2ha',
-                'name': 'cbus2ha',
-                'manufacturer': 'Clipsal CBus Home Automation',
-                'model': 'cbus2ha',
-            },
-        })
+        """
+        Publishes a payload as JSON.
 
-        for ga in ga_range():
-            device_type = get_device_type(ga, device_types)
-            
-            # Skip ignored devices completely
-            if device_type == _DEVICE_TYPE_IGNORE:
-                continue
-            
-            name = labels.get(ga, f'C-Bus {device_type.replace("_", " ").title()} {ga:03d}')
-            
-            if device_type == _DEVICE_TYPE_LIGHT:
-                self._publish_light_config(ga, name, dimmable=True)
-            elif device_type == _DEVICE_TYPE_LIGHT_NON_DIMMABLE:
-                self._publish_light_config(ga, name, dimmable=False)
-            elif device_type == _DEVICE_TYPE_SWITCH:
-                self._publish_switch_config(ga, name)
-            elif device_type == _DEVICE_TYPE_BINARY_SENSOR:
-                self._publish_binary_sensor_config(ga, name)
-
-    def _publish_light_config(self, ga: int, name: str, dimmable: bool = True):
-        """Publish light entity configuration."""
-        config = {
-            'name': name,
-            'unique_id': f'cbus_light_{ga}',
-            'cmd_t': set_topic(ga),
-            'stat_t': state_topic(ga),
-            'schema': 'json',
-            'brightness': dimmable,  # Key difference!
-            'device': {
-                'identifiers': [f'cbus_light_{ga}'],
-                'connections': [['cbus_group_address', str(ga)]],
-                'sw_version': 'cbus2ha https://github.com/wazza-aus/cbus2ha',
-                'name': f'C-Bus Light {ga:03d}',
-                'manufacturer': 'Clipsal CBus Home Automation',
-                'model': 'cbus2ha',
-                'via_device': 'cbus2ha',
-            },
-        }
-        # Add supported_color_modes based on dimmable capability
-        if dimmable:
-            config['supported_color_modes'] = ['brightness']
-        else:
-            config['supported_color_modes'] = ['onoff']
-        self.publish(conf_topic(ga), config)
-
-    def _publish_switch_config(self, ga: int, name: str):
-        """Publish switch entity configuration."""
-        topic = _SWITCH_TOPIC_PREFIX + str(ga) + _TOPIC_CONF_SUFFIX
-        self.publish(topic, {
-            'name': name,
-            'unique_id': f'cbus_switch_{ga}',
-            'cmd_t': _SWITCH_TOPIC_PREFIX + str(ga) + _TOPIC_SET_SUFFIX,
-            'stat_t': _SWITCH_TOPIC_PREFIX + str(ga) + _TOPIC_STATE_SUFFIX,
-            'schema': 'json',
-            'device': {
-                'identifiers': [f'cbus_switch_{ga}'],
-                'connections': [['cbus_group_address', str(ga)]],
-                'sw_version': 'cbus2ha https://github.com/wazza-aus/cbus2ha',
-                'name': f'C-Bus Switch {ga:03d}',
-                'manufacturer': 'Clipsal CBus Home Automation',
-                'model': 'cbus2ha',
-                'via_device': 'cbus2ha',
-            },
-        })
+        Publishes are held for _PUBLISH_COALESCE_DELAY seconds so that bursts
+        (such as scene recalls) are sent back-to-back, and only the latest
+        payload for each topic is sent. All payloads are retained, so the
+        intermediate states are never needed.
+        """
+        self._publish_coalesced(topic, orjson.dumps(payload))
+
+    def _publish_coalesced(self, topic: Text, payload: bytes):
+        """Queues an already-encoded payload for _flush_publishes."""
+        self._pending_publishes[topic] = payload
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(
+                _PUBLISH_COALESCE_DELAY, self._flush_publishes)
+
+    def _flush_publishes(self):
+        """Sends all payloads queued by publish()."""
+        self._flush_handle = None
+        pending, self._pending_publishes = self._pending_publishes, {}
+        for topic, payload in pending.items():
+            super().publish(topic, payload, 1, True)
+
+    def _publish_raw(self, topic: Text, payload: bytes, retain: bool = True):
+        """Publishes an already-encoded payload immediately."""
+        return super().publish(topic, payload, 1, retain)
+
+    def publish_discovery_configs(self, configs: Iterable[Tuple[Text, bytes]]):
+        """Publishes (topic, payload) pairs from _build_all_discovery_configs."""
+        for topic, payload in configs:
+            self._publish_raw(topic, payload)
 
     def _publish_binary_sensor_state_tracker(self, ga: int, name: str):
         """Publish binary sensor for state tracking (existing behavior)."""
-        self.publish(bin_sensor_conf_topic(ga), {
+        self.publish(_BINSENSOR_CONF[ga], {
             'name': f'{name} (as binary sensor)',
             'unique_id': f'cbus_bin_sensor_{ga}',
-            'stat_t': bin_sensor_state_topic(ga),
-            'device': {
-                'identifiers': [f'cbus_bin_sensor_{ga}'],
-                'connections': [['cbus_group_address', str(ga)]],
-                'sw_version': 'cbus2ha https://github.com/wazza-aus/cbus2ha',
-                'name': f'C-Bus Light {ga:03d}',
-                'manufacturer': 'Clipsal CBus Home Automation',
-                'model': 'cbus2ha',
-                'via_device': 'cbus2ha',
-            },
+            'stat_t': _BINSENSOR_STATE[ga],
+            'device': _device_block(
+                f'cbus_bin_sensor_{ga}', f'C-Bus Light {ga:03d}',
+                connections=[['cbus_group_address', str(ga)]],
+                via_device='cbus2ha'),
         })
 
-    def _publish_binary_sensor_config(self, ga: int, name: str):
-        """Publish binary sensor entity configuration (read-only)."""
-        self.publish(bin_sensor_conf_topic(ga), {
-            'name': name,
-            'unique_id': f'cbus_binary_sensor_{ga}',
-            'stat_t': bin_sensor_state_topic(ga),
-            'device': {
-                'identifiers': [f'cbus_binary_sensor_{ga}'],
-                'connections': [['cbus_group_address', str(ga)]],
-                'sw_version': 'cbus2ha https://github.com/wazza-aus/cbus2ha',
-                'name': f'C-Bus Binary Sensor {ga:03d}',
-                'manufacturer': 'Clipsal CBus Home Automation',
-                'model': 'cbus2ha',
-                'via_device': 'cbus2ha',
-            },
-        })
+    def _publish_lighting(self, group_addr: int,
+                          device_type: Optional[DeviceType], state: bytes,
+                          brightness: int, transition: int,
+                          source_addr: Optional[int]):
+        """Publishes the state of a group address after a lighting event."""
+        if device_type is None:
+            device_type = DeviceType.LIGHT  # Default for backward compatibility
+        info = _GA_INFO[device_type][group_addr]
 
-    def publish_binary_sensor(self, group_addr: int, state: bool):
-        payload = 'ON' if state else 'OFF'
-        return super().publish(
-            bin_sensor_state_topic(group_addr), payload, 1, True)
+        if info.plain_state:
+            # Switches and binary sensors need plain string state updates
+            self._publish_coalesced(info.state_topic, state)
+        else:
+            self._publish_coalesced(info.state_topic, _light_state_payload(
+                info.light_state, state, brightness, transition, source_addr))
 
     def lighting_group_on(self, source_addr: Optional[int], group_addr: int,
-                          device_type: Optional[str] = None):
+                          device_type: Optional[DeviceType] = None):
         """Relays a lighting-on event from CBus to MQTT."""
-        if device_type is None:
-            device_type = _DEVICE_TYPE_LIGHT  # Default for backward compatibility
-        
-        # Binary sensors only publish to binary sensor topic
-        if device_type == _DEVICE_TYPE_BINARY_SENSOR:
-            self.publish_binary_sensor(group_addr, True)
-            return
-        
-        state_topic_str = state_topic_for_device(group_addr, device_type)
-        
-        # Switches need plain string state updates, lights need JSON
-        if device_type == _DEVICE_TYPE_SWITCH:
-            # Publish plain string for switches
-            super().publish(state_topic_str, 'ON', 1, True)
-        else:
-            # Publish JSON for lights
-            payload = {
-                'state': 'ON',
-                'brightness': 255,
-                'transition': 0,
-                'cbus_source_addr': source_addr,
-            }
-            # Set color_mode based on whether light is dimmable
-            if device_type == _DEVICE_TYPE_LIGHT_NON_DIMMABLE:
-                payload['color_mode'] = 'onoff'
-            else:
-                payload['color_mode'] = 'brightness'
-            self.publish(state_topic_str, payload)
+        self._publish_lighting(
+            group_addr, device_type, _STATE_ON, 255, 0, source_addr)
 
     def lighting_group_off(self, source_addr: Optional[int], group_addr: int,
-                           device_type: Optional[str] = None):
+                           device_type: Optional[DeviceType] = None):
         """Relays a lighting-off event from CBus to MQTT."""
-        if device_type is None:
-            device_type = _DEVICE_TYPE_LIGHT
-        
-        # Binary sensors only publish to binary sensor topic
-        if device_type == _DEVICE_TYPE_BINARY_SENSOR:
-            self.publish_binary_sensor(group_addr, False)
-            return
-        
-        state_topic_str = state_topic_for_device(group_addr, device_type)
-        
-        # Switches need plain string state updates, lights need JSON
-        if device_type == _DEVICE_TYPE_SWITCH:
-            # Publish plain string for switches
-            super().publish(state_topic_str, 'OFF', 1, True)
-        else:
-            # Publish JSON for lights
-            payload = {
-                'state': 'OFF',
-                'brightness': 0,
-                'transition': 0,
-                'cbus_source_addr': source_addr,
-            }
-            # Set color_mode based on whether light is dimmable
-            if device_type == _DEVICE_TYPE_LIGHT_NON_DIMMABLE:
-                payload['color_mode'] = 'onoff'
-            else:
-                payload['color_mode'] = 'brightness'
-            self.publish(state_topic_str, payload)
+        self._publish_lighting(
+            group_addr, device_type, _STATE_OFF, 0, 0, source_addr)
 
     def lighting_group_ramp(self, source_addr: Optional[int], group_addr: int,
-                           duration: int, level: int, device_type: Optional[str] = None):
+                           duration: int, level: int, device_type: Optional[DeviceType] = None):
         """Relays a lighting-ramp event from CBus to MQTT."""
-        if device_type is None:
-            device_type = _DEVICE_TYPE_LIGHT
-        
-        # Binary sensors only publish to binary sensor topic
-        if device_type == _DEVICE_TYPE_BINARY_SENSOR:
-            self.publish_binary_sensor(group_addr, level > 0)
-            return
-        
-        state_topic_str = state_topic_for_device(group_addr, device_type)
-        state = 'OFF' if level == 0 else 'ON'
-        
-        # Switches need plain string state updates, lights need JSON
-        if device_type == _DEVICE_TYPE_SWITCH:
-            # Publish plain string for switches
-            super().publish(state_topic_str, state, 1, True)
-        else:
-            # Publish JSON for lights
-            payload = {
-                'state': state,
-                'brightness': level,
-                'transition': duration,
-                'cbus_source_addr': source_addr,
-            }
-            # Set color_mode based on whether light is dimmable
-            if device_type == _DEVICE_TYPE_LIGHT_NON_DIMMABLE:
-                payload['color_mode'] = 'onoff'
-            else:
-                payload['color_mode'] = 'brightness'
-            self.publish(state_topic_str, payload)
+        self._publish_lighting(
+            group_addr, device_type, _STATE_OFF if level == 0 else _STATE_ON,
+            level, duration, source_addr)
 
 
 def read_auth(client: mqtt.Client, auth_file: TextIO):
@@ -886,40 +949,65 @@ def read_auth(client: mqtt.Client, auth_file: TextIO):
     client.username_pw_set(username, password)
 
 
+def _is_default_label(name: Text, group_addr: int) -> bool:
+    """Checks if a group label is empty or one Toolkit generated."""
+    return (not name or name == '<Unused>' or (
+        # Only build the expected name for labels which could match it
+        name.startswith('Group ') and name == f'Group {group_addr}'))
+
+
 def read_cbz_labels(cbz_file: BinaryIO) -> Dict[int, Text]:
     """Reads group address names from a given Toolkit CBZ file."""
-    labels = {}  # type: Dict[int, Text]
     cbz = CBZ(cbz_file)
 
     # TODO: support multiple networks/applications
     # Look for 1 direct network
-    networks = [n for n in cbz.installation.project.network
-                if n.interface.interface_type != 'bridge']
-    if len(networks) != 1:
+    network = None
+    network_count = 0
+    for n in cbz.installation.project.network:
+        if n.interface.interface_type != 'bridge':
+            network = n
+            network_count += 1
+    if network_count != 1:
         logger.warning('Expected exactly 1 non-bridge network in project file, '
                        'got %d instead! Labels will be unavailable.',
-                       len(networks))
-        return labels
-
-    # Look for
-    applications = [a for a in networks[0].applications
-                    if a.address == Application.LIGHTING]
-    if len(applications) != 1:
+                       network_count)
+        return {}
+
+    # Look for the lighting application
+    application = None
+    application_count = 0
+    for a in network.applications:
+        if a.address == Application.LIGHTING:
+            application = a
+            application_count += 1
+    if application_count != 1:
         logger.warning('Could not find lighting application %x in project '
                        'file. Labels will be unavailable.',
                        Application.LIGHTING)
-        return labels
+        return {}
 
-    for group in applications[0].groups:
-        name = group.tag_name.strip()
+    return {
+        group.address: name
+        for group in application.groups
+        if not _is_default_label(name := group.tag_name.strip(), group.address)
+    }
 
-        # Ignore default names
-        if not name or name in ('<Unused>', f'Group {group.address}'):
-            continue
 
-        labels[group.address] = name
+def _ga_list(value: Text) -> FrozenSet[int]:
+    """
+    Parses a comma-separated list of group addresses from the command line.
 
-    return labels
+    :raises ArgumentTypeError: If any entry is not a valid group address.
+    """
+    group_addrs = set()
+    for match in _GA_LIST_ITEM.finditer(value):
+        ga_str = match.group()
+        if (not ga_str.isdecimal() or
+                not MIN_GROUP_ADDR <= (ga := int(ga_str)) <= MAX_GROUP_ADDR):
+            raise ArgumentTypeError(f'invalid group address: {ga_str!r}')
+        group_addrs.add(ga)
+    return frozenset(group_addrs)
 
 
 async def _main():
@@ -1034,22 +1122,22 @@ async def _main():
     group = parser.add_argument_group('Device type configuration')
     group.add_argument(
         '--non-dimmable-lights',
-        dest='non_dimmable_lights', default='',
+        dest='non_dimmable_lights', type=_ga_list, default=frozenset(),
         help='Comma-separated list of group addresses for non-dimmable lights '
              '(e.g., "26,65,81")')
     group.add_argument(
         '--switches',
-        dest='switches', default='',
+        dest='switches', type=_ga_list, default=frozenset(),
         help='Comma-separated list of group addresses for switches '
              '(e.g., "15,90")')
     group.add_argument(
         '--binary-sensors',
-        dest='binary_sensors', default='',
+        dest='binary_sensors', type=_ga_list, default=frozenset(),
         help='Comma-separated list of group addresses for binary sensors '
              '(read-only state tracking, e.g., "10,20,30")')
     group.add_argument(
         '--ignore',
-        dest='ignore', default='',
+        dest='ignore', type=_ga_list, default=frozenset(),
         help='Comma-separated list of group addresses to ignore '
              '(no MQTT discovery or subscriptions, e.g., "5,15,25")')
 
@@ -1059,6 +1147,12 @@ async def _main():
         return parser.error(
             'To use client certificates, both -k and -K must be specified.')
 
+    if option.tcp:
+        tcp_addr, _, tcp_port = option.tcp.rpartition(':')
+        if not tcp_addr or not tcp_port.isdecimal():
+            return parser.error(
+                f'-t must be given as ADDR:PORT, got {option.tcp!r}')
+
     global_logger = logging.getLogger('cbus')
     global_logger.setLevel(option.verbosity)
     logging.basicConfig(level=option.verbosity, filename=option.log)
@@ -1069,30 +1163,20 @@ async def _main():
     # explicitly ensure it has the right level
     logger.setLevel(option.verbosity)
 
-    loop = get_event_loop()
+    loop = get_running_loop()
     connection_lost_future = loop.create_future()
     labels = (read_cbz_labels(option.project_file)
               if option.project_file else None)
 
-    # Parse device type configurations
-    device_types = {}  # group_addr -> device_type_string
-
-    def parse_device_list(ga_list_str: str, device_type: str):
-        """Parse comma-separated group addresses and assign device type."""
-        if not ga_list_str:
-            return
-        for ga_str in ga_list_str.split(','):
-            try:
-                ga = int(ga_str.strip())
-                check_ga(ga)
-                device_types[ga] = device_type
-            except (ValueError, TypeError):
-                logger.warning(f'Invalid group address in {device_type}: {ga_str}')
-
-    parse_device_list(option.non_dimmable_lights, _DEVICE_TYPE_LIGHT_NON_DIMMABLE)
-    parse_device_list(option.switches, _DEVICE_TYPE_SWITCH)
-    parse_device_list(option.binary_sensors, _DEVICE_TYPE_BINARY_SENSOR)
-    parse_device_list(option.ignore, _DEVICE_TYPE_IGNORE)
+    # Apply device type configurations. Later options take precedence if a
+    # group address is given more than once.
+    device_types = {}  # type: Dict[int, DeviceType]
+    for group_addrs, device_type in (
+            (option.non_dimmable_lights, DeviceType.LIGHT_NON_DIMMABLE),
+            (option.switches, DeviceType.SWITCH),
+            (option.binary_sensors, DeviceType.BINARY_SENSOR),
+            (option.ignore, DeviceType.IGNORE)):
+        device_types.update(dict.fromkeys(group_addrs, device_type))
 
     def factory():
         return CBusHandler(
@@ -1107,9 +1191,8 @@ async def _main():
         _, protocol = await create_serial_connection(
             loop, factory, option.serial, baudrate=9600)
     elif option.tcp:
-        addr = option.tcp.split(':', 2)
         _, protocol = await loop.create_connection(
-            factory, addr[0], int(addr[1]))
+            factory, tcp_addr, int(tcp_port))
 
     mqtt_client = MqttClient(userdata=protocol)
     if option.broker_auth:
@@ -1127,15 +1210,22 @@ async def _main():
         mqtt_client.tls_set(**tls_args)
         port = option.broker_port or 8883
 
-    aioh = AsyncioHelper(loop, mqtt_client)
+    # paho runs its own network thread, and hands work to the event loop.
     mqtt_client.connect(option.broker_address, port, option.broker_keepalive)
+    mqtt_client.loop_start()
 
-    await connection_lost_future
+    try:
+        await connection_lost_future
+    finally:
+        mqtt_client.loop_stop()
 
 
 def main():
     # work-around asyncio vs. setuptools console_scripts
-    run(_main())
+    if uvloop is not None:
+        uvloop.run(_main())
+    else:
+        run(_main())
 
 
 if __name__ == '__main__':
@@ -1,35 +0,0 @@
-# https://github.com/eclipse/paho.mqtt.python/blob/master/examples/loop_asyncio.py
-import asyncio
-import paho.mqtt.client as mqtt
-
-
-class AsyncioHelper:
-    def __init__(self, loop, client):
-        self.loop = loop
-        self.client = client
-        self.client.on_socket_open = self.on_socket_open
-        self.client.on_socket_close = self.on_socket_close
-        self.client.on_socket_register_write = self.on_socket_register_write
-        self.client.on_socket_unregister_write = self.on_socket_unregister_write
-        self.misc = None
-
-    def on_socket_open(self, client, userdata, sock):
-        self.loop.add_reader(sock, client.loop_read)
-        self.misc = self.loop.create_task(self.misc_loop())
-
-    def on_socket_close(self, client, userdata, sock):
-        self.loop.remove_reader(sock)
-        self.misc.cancel()
-
-    def on_socket_register_write(self, client, userdata, sock):
-        self.loop.add_writer(sock, client.loop_write)
-
-    def on_socket_unregister_write(self, client, userdata, sock):
-        self.loop.remove_writer(sock)
-
-    async def misc_loop(self):
-        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
-            try:
-                await asyncio.sleep(1)
-            except asyncio.CancelledError:
-                break
@@ -8,7 +8,8 @@ deps = [
 	'lxml (>=2.3.2)',
 	'six',
 	'pydot',
-	'paho_mqtt (==1.5.0)'
+	'paho_mqtt (==1.5.0)',
+	'orjson',
 ]
 
 tests_require = [
@@ -24,9 +25,14 @@ setup(
 	author_email="micolous@gmail.com",
 	url="https://github.com/micolous/cbus",
 	license="LGPL3+",
+	python_requires='>=3.10',
 	requires=deps,
 	tests_require=tests_require,
-	extras_require={'test': tests_require},
+	extras_require={
+		'test': tests_require,
+		# optional: faster event loop for cmqttd
+		'uvloop': ['uvloop (>=0.18)'],
+	},
 	# TODO: add scripts to this.
 	packages=find_packages(),
 	
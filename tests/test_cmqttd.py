@@ -17,11 +17,16 @@
 
 from __future__ import absolute_import
 
+from argparse import ArgumentTypeError
+import asyncio
 from dataclasses import dataclass
 from parameterized import parameterized
 import io
+from itertools import chain, count
+import json
 from typing import Optional, Text, cast
 import unittest
+from unittest import mock
 
 from cbus.common import check_ga
 from cbus.daemon import cmqttd
@@ -101,6 +106,113 @@ class CmqttdUtilityTest(unittest.TestCase):
     def test_invalid_topic_group_address(self, topic):
         self.assertRaises(ValueError, cmqttd.get_topic_group_address, topic)
 
+    @parameterized.expand([
+        ('plain on', b'ON', {'state': 'ON'}),
+        ('plain off', b'OFF', {'state': 'OFF'}),
+        ('quoted on', b'"ON"', {'state': 'ON'}),
+        ('lower case', b' off\n', {'state': 'OFF'}),
+        ('json', b'{"state":"ON","brightness":128,"transition":2}',
+         {'state': 'ON', 'brightness': 128, 'transition': 2}),
+        ('leading whitespace json', b' {"state":"ON"}', {'state': 'ON'}),
+    ])
+    def test_decode_command_payload(self, _name, payload, expected):
+        self.assertEqual(expected, cmqttd.decode_command_payload(payload))
+
+    @parameterized.expand([
+        ('empty', b''),
+        ('unknown state', b'TOGGLE'),
+        ('bad json', b'{"state":'),
+        ('json without state', b'{"brightness":128}'),
+        ('json list', b'["ON"]'),
+    ])
+    def test_invalid_command_payload(self, _name, payload):
+        self.assertIsNone(cmqttd.decode_command_payload(payload))
+
+    @parameterized.expand([
+        ('light', cmqttd.DeviceType.LIGHT_NON_DIMMABLE, 'Kitchen "Main"'),
+        ('switch', cmqttd.DeviceType.SWITCH, 'Fan __GA__'),
+        ('switch', cmqttd.DeviceType.SWITCH, 'Fan 100%% %(ga)d'),
+        ('binary_sensor', cmqttd.DeviceType.BINARY_SENSOR, 'Motion \u00fc'),
+    ])
+    def test_render_discovery_config(self, kind, device_type, name):
+        config = json.loads(cmqttd._render_discovery_config(
+            cmqttd._DISCOVERY_TEMPLATES[device_type], 7, name))
+        self.assertEqual(name, config['name'])
+        self.assertEqual(f'cbus_{kind}_7', config['unique_id'])
+        self.assertIn('_7/state', config['stat_t'])
+        self.assertEqual([f'cbus_{kind}_7'], config['device']['identifiers'])
+        self.assertEqual([['cbus_group_address', '7']],
+                         config['device']['connections'])
+        self.assertTrue(config['device']['name'].endswith(' 007'))
+
+    def test_build_all_discovery_configs(self):
+        device_types = {
+            2: cmqttd.DeviceType.SWITCH,
+            3: cmqttd.DeviceType.IGNORE,
+        }
+        ga_info = [
+            cmqttd._GA_INFO[device_types.get(
+                ga, cmqttd.DeviceType.LIGHT)][ga]
+            for ga in range(256)]
+        labels = [None] * 256
+        labels[1] = 'Kitchen'
+
+        configs = cmqttd._build_all_discovery_configs(
+            labels, ga_info, [1, 2, 3])
+        self.assertEqual([
+            'homeassistant/binary_sensor/cbus_cmqttd/config',
+            'homeassistant/light/cbus_1/config',
+            'homeassistant/switch/cbus_2/config',
+        ], [topic for topic, _ in configs])
+        self.assertEqual('Kitchen', json.loads(configs[1][1])['name'])
+        self.assertEqual('C-Bus Switch 002',
+                         json.loads(configs[2][1])['name'])
+
+    @parameterized.expand([
+        ('empty', '', frozenset()),
+        ('single', '26', frozenset({26})),
+        ('list', '26,65,81', frozenset({26, 65, 81})),
+        ('whitespace', ' 0, 255 ,,', frozenset({0, 255})),
+    ])
+    def test_ga_list(self, _name, value, expected):
+        self.assertEqual(expected, cmqttd._ga_list(value))
+
+    @parameterized.expand([
+        ('not a number', '26,kitchen'),
+        ('negative', '-5'),
+        ('out of range', '256'),
+    ])
+    def test_invalid_ga_list(self, _name, value):
+        self.assertRaises(ArgumentTypeError, cmqttd._ga_list, value)
+
+    @parameterized.expand([
+        ('empty', '', True),
+        ('unused', '<Unused>', True),
+        ('generated', 'Group 12', True),
+        ('other group', 'Group 13', False),
+        ('group prefix', 'Group 12 lamp', False),
+        ('label', 'Kitchen', False),
+    ])
+    def test_is_default_label(self, _name, label, expected):
+        self.assertEqual(expected, cmqttd._is_default_label(label, 12))
+
+    @parameterized.expand([
+        ('dimmable', cmqttd.DeviceType.LIGHT, 12, 'brightness'),
+        ('non-dimmable', cmqttd.DeviceType.LIGHT_NON_DIMMABLE, None, 'onoff'),
+    ])
+    def test_light_state_payload(self, _name, device_type, source_addr,
+                                 color_mode):
+        info = cmqttd._GA_INFO[device_type][7]
+        payload = json.loads(cmqttd._light_state_payload(
+            info.light_state, b'ON', 128, 2, source_addr))
+        self.assertEqual({
+            'state': 'ON',
+            'brightness': 128,
+            'transition': 2,
+            'cbus_source_addr': source_addr,
+            'color_mode': color_mode,
+        }, payload)
+
     @parameterized.expand([
         ('unix newlines', 'my_username\nmy_password\n'),
         ('dos newlines', 'my_username\r\nmy_password\r\n'),
@@ -113,3 +225,187 @@ class CmqttdUtilityTest(unittest.TestCase):
         cmqttd.read_auth(cast('mqtt.Client', client), f)
         self.assertEqual('my_username', client.username)
         self.assertEqual('my_password', client.password)
+
+    def test_on_connect_schedules_handler(self):
+        # paho calls on_connect from its network thread, so the real work must
+        # be handed to the event loop as a bound method.
+        async def connect():
+            client = cmqttd.MqttClient()
+            with mock.patch.object(
+                    client._loop, 'call_soon_threadsafe') as call_soon:
+                client.on_connect(client, None, {}, 0)
+            return client, call_soon
+
+        client, call_soon = asyncio.run(connect())
+        call_soon.assert_called_once()
+        callback, userdata = call_soon.call_args[0]
+        self.assertTrue(callable(callback))
+        self.assertIs(client, callback.__self__)
+        self.assertIsNone(userdata)
+
+    def test_publish_coalesced(self):
+        async def publish():
+            client = cmqttd.MqttClient()
+            with mock.patch.object(cmqttd.mqtt.Client, 'publish') as publish:
+                client.publish('a/state', {'state': 'ON'})
+                client.publish('b/state', {'state': 'ON'})
+                client.publish('a/state', {'state': 'OFF'})
+                # Nothing is sent until the coalescing window has passed.
+                publish.assert_not_called()
+                await asyncio.sleep(cmqttd._PUBLISH_COALESCE_DELAY * 4)
+            return publish
+
+        publish = asyncio.run(publish())
+        self.assertEqual([
+            mock.call('a/state', b'{"state":"OFF"}', 1, True),
+            mock.call('b/state', b'{"state":"ON"}', 1, True),
+        ], publish.call_args_list)
+
+
+async def _wait_until(predicate, timeout: float = 1.0):
+    """Polls predicate on the running event loop until it returns True."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError('timed out waiting for the queue')
+        await asyncio.sleep(0.001)
+
+
+class CBusHandlerQueueTest(unittest.TestCase):
+    """Tests for CBusHandler's command queue."""
+
+    def setUp(self):
+        # Scale down the 100 ms send spacing and the confirmation timeout by
+        # the same factor, so they keep their real ratio.
+        for patcher in (
+                mock.patch.object(cmqttd, '_CONFIRMATION_TIMEOUT', 0.025),
+                mock.patch.object(
+                    cmqttd, 'sleep', lambda delay: asyncio.sleep(delay / 10))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_queue(self, scenario, codes=(), confirm=frozenset()):
+        """
+        Runs scenario(handler, sends) with the queue processor started.
+
+        lighting_group_on/off send to a stub PCI, which records
+        (group_addr, send time) in sends. Each send returns the next code in
+        codes, then a new code once those run out.
+
+        :param confirm: Indexes of the sends which the PCI confirms straight
+                        away.
+        :returns: (handler, sends)
+        """
+        async def run():
+            loop = asyncio.get_running_loop()
+            handler = cmqttd.CBusHandler(labels=None)
+            handler.mqtt_api = mock.Mock()
+            sends = []
+            next_code = chain(codes, (b'%d' % i for i in count())).__next__
+
+            def send(group_addr):
+                code = next_code()
+                if len(sends) in confirm:
+                    loop.call_soon(handler.on_confirmation, code, True)
+                sends.append((group_addr, loop.time()))
+                return code
+
+            handler.lighting_group_on = handler.lighting_group_off = send
+            handler.start_queue_system()
+            try:
+                await scenario(handler, sends)
+            finally:
+                handler.stop_queue_system()
+            return handler, sends
+
+        return asyncio.run(run())
+
+    def test_queue_order(self):
+        # Retries are sent before new commands, and each priority is FIFO.
+        async def drain():
+            handler = cmqttd.CBusHandler(labels=None)
+            handler.queue_command('on', 1, cmqttd.DeviceType.LIGHT)
+            handler.queue_command('off', 2, cmqttd.DeviceType.LIGHT)
+            # queue_command hands the command to the loop thread-safely
+            await asyncio.sleep(0)
+            for ga in (10, 11):
+                handler._queue_retry(cmqttd.QueuedCommand(
+                    'on', ga, cmqttd.DeviceType.LIGHT, retry_count=1))
+            handler.queue_command('on', 3, cmqttd.DeviceType.LIGHT)
+            await asyncio.sleep(0)
+
+            queue = handler.command_queue
+            return [queue.get_nowait()[2].group_addr
+                    for _ in range(queue.qsize())]
+
+        self.assertEqual([10, 11, 1, 2, 3], asyncio.run(drain()))
+
+    def test_confirmed_not_retried(self):
+        async def scenario(handler, sends):
+            handler.queue_command('on', 1, cmqttd.DeviceType.LIGHT)
+            await _wait_until(lambda: sends)
+            await asyncio.sleep(cmqttd._CONFIRMATION_TIMEOUT * 2)
+
+        handler, sends = self.run_queue(scenario, confirm={0})
+        self.assertEqual([1], [ga for ga, _ in sends])
+        self.assertEqual({}, handler.pending_confirmations)
+        handler.mqtt_api.lighting_group_on.assert_called_once_with(
+            None, 1, cmqttd.DeviceType.LIGHT)
+
+    def test_timeout_retried_before_new_commands(self):
+        async def scenario(handler, sends):
+            for ga in (1, 2, 3, 4):
+                handler.queue_command('on', ga, cmqttd.DeviceType.LIGHT)
+            await _wait_until(lambda: 4 in [ga for ga, _ in sends])
+
+        _, sends = self.run_queue(scenario)
+        gas = [ga for ga, _ in sends]
+        # GA 1 times out while GA 2 and 3 are sent, and is retried before the
+        # GA 4 command which was queued ahead of the retry.
+        self.assertEqual(1, gas[0])
+        self.assertLess(gas.index(1, 1), gas.index(4))
+
+    def test_reused_code_not_expired_early(self):
+        async def scenario(handler, sends):
+            handler.queue_command('on', 1, cmqttd.DeviceType.LIGHT)
+            handler.queue_command('off', 2, cmqttd.DeviceType.LIGHT)
+            await _wait_until(lambda: len(sends) >= 3)
+
+        # GA 1 is confirmed, and GA 2 is then sent with the same code but
+        # never confirmed.
+        _, sends = self.run_queue(
+            scenario, codes=(b'x', b'x'), confirm={0})
+        _, (ga, sent), (retry_ga, retried) = sends[:3]
+        self.assertEqual((2, 2), (ga, retry_ga))
+        # GA 1's deadline expires first, but GA 2 must wait for its own.
+        self.assertGreater(
+            retried - sent, cmqttd._CONFIRMATION_TIMEOUT - 0.001)
+
+    def test_dropped_after_max_retries(self):
+        async def scenario(handler, sends):
+            handler.queue_command('on', 1, cmqttd.DeviceType.LIGHT)
+            await _wait_until(lambda: (
+                len(sends) > cmqttd._MAX_RETRIES
+                and not handler.pending_confirmations))
+            await asyncio.sleep(cmqttd._CONFIRMATION_TIMEOUT * 2)
+
+        handler, sends = self.run_queue(scenario)
+        self.assertEqual(
+            [1] * (cmqttd._MAX_RETRIES + 1), [ga for ga, _ in sends])
+        handler.mqtt_api.lighting_group_on.assert_not_called()
+
+    def test_stop_clears_pending(self):
+        async def scenario(handler, sends):
+            handler.queue_command('on', 1, cmqttd.DeviceType.LIGHT)
+            handler.queue_command('off', 2, cmqttd.DeviceType.LIGHT)
+            await _wait_until(lambda: len(sends) == 2)
+            handler.stop_queue_system()
+            self.assertEqual({}, handler.pending_confirmations)
+            self.assertFalse(handler._pending_deadlines)
+            await asyncio.sleep(cmqttd._CONFIRMATION_TIMEOUT * 2)
+
+        handler, sends = self.run_queue(scenario)
+        self.assertEqual(2, len(sends))
+        handler.mqtt_api.lighting_group_on.assert_not_called()
+        handler.mqtt_api.lighting_group_off.assert_not_called()